@@ -5,19 +5,56 @@ Simple telnet chat server using gevent.
 
 """
 
+import collections
 import logging
 
 import gevent
+import gevent.event
 import gevent.server
-from gevent.queue import Queue
-from gevent import monkey ; monkey.patch_all()
+from gevent import monkey ; monkey.patch_socket() ; monkey.patch_select()
 
 from chatty_conf import config
 
+_STATUS_SET = frozenset(config["STATUS_LIST"])
+_STATUS_DISPLAY = ", ".join(config["STATUS_LIST"])
+_STATUS_PIPE = "|".join(config["STATUS_LIST"])
+
 __author__ = "Niclas helbro"
 __version__ = "0.1"
 
-logging.getLogger('').setLevel(logging.DEBUG)
+logging.getLogger('').setLevel(getattr(logging, config.get("LOG_LEVEL", "DEBUG")))
+
+# ANSI color format strings by message type.
+_COLOR_CODES = {
+    "status": "\x1b[34m%s\x1b[0m",
+    "private": "\x1b[32m%s\x1b[0m",
+    "public": "\x1b[35m%s\x1b[0m",
+    "info": "\x1b[33m%s\x1b[0m",
+    "warning": "\x1b[33m%s\x1b[0m",
+    "error": "\x1b[31m%s\x1b[0m",
+}
+
+
+class Mailbox(object):
+    """
+    Private message mailbox of a single user. Only the user's own message
+    listener reads from it, so a deque and an event to wake the listener
+    up are all that is needed.
+
+    """
+    __slots__ = ("dq", "ev")
+
+    def __init__(self):
+        self.dq = collections.deque()
+        self.ev = gevent.event.Event()
+
+    def put(self, item):
+        """
+        Add an item to the mailbox and wake up the listener.
+
+        """
+        self.dq.append(item)
+        self.ev.set()
 
 
 class ChattyServer(object):
@@ -26,11 +63,26 @@ class ChattyServer(object):
     connections.
 
     """
+    __slots__ = (
+        "connected_users", "message_queues",
+        "broadcast_seq", "broadcast_log", "broadcast_event",
+        "_users_cache_blob",
+    )
+
     def __init__(self):
-        self.config = config
         self.connected_users = {}
         self.message_queues = {}
 
+        # Public messages are appended once to a shared log of
+        # `(seq, message, message_type)` tuples which every message listener
+        # reads from using its own cursor. Only the latest messages are kept.
+        self.broadcast_seq = 0
+        self.broadcast_log = collections.deque(maxlen=1024)
+        self.broadcast_event = gevent.event.Event()
+
+        # Rendered user list, rebuilt on demand after it is invalidated.
+        self._users_cache_blob = None
+
     def new_connection(self, username):
         """
         Register a new connection by username and broadcast the event to
@@ -38,7 +90,8 @@ class ChattyServer(object):
 
         """
         self.connected_users[username] = "Online"
-        self.message_queues[username] = gevent.queue.Queue()
+        self._users_cache_blob = None
+        self.message_queues[username] = Mailbox()
         self.send_message(username, "Joined chatty.", message_type="status")
 
     def end_connection(self, username):
@@ -47,11 +100,13 @@ class ChattyServer(object):
         other users.
 
         """
-        if username in self.connected_users:
-            del(self.connected_users[username])
+        if self.connected_users.pop(username, None) is not None:
+            self._users_cache_blob = None
 
-        if username in self.message_queues:
-            del(self.message_queues[username])
+        # Wake up the user's message listener so that it can exit.
+        mailbox = self.message_queues.pop(username, None)
+        if mailbox is not None:
+            mailbox.put(None)
 
         self.send_message(username, "Left chatty.", message_type="status")
 
@@ -63,22 +118,37 @@ class ChattyServer(object):
 
         """
         if username in self.connected_users:
-            if status in self.config["STATUS_LIST"]:
+            if status in _STATUS_SET:
                 self.connected_users[username] = status
+                self._users_cache_blob = None
                 self.send_message(
                     username,
-                    "Updated status to %s." % status,
+                    "Updated status to " + status + ".",
                     message_type="status"
                 )
                 return True, "Status updated."
 
             return False, "Status '%s' is not allowed. Choose one from %s." % (
-                status,
-                ", ".join(self.config["STATUS_LIST"])
+                status, _STATUS_DISPLAY
             )
         else:
             return False, "User is not connected."
 
+    def render_user_list(self):
+        """
+        Returns the colorized list of connected users, ready to be sent to a
+        telnet client.
+
+        """
+        if self._users_cache_blob is None:
+            fmt = _COLOR_CODES["status"] + "\n"
+            lines = [fmt % "  CONNECTED USERS:"]
+            for user, status in self.connected_users.items():
+                lines.append(fmt % ("    %s (%s)" % (user, status)))
+            self._users_cache_blob = "".join(lines).encode("utf-8")
+
+        return self._users_cache_blob
+
     def send_message(self, username, message, to_username=None, message_type="public"):
         """
         Sends a private or public message. This is used both for actual chat
@@ -90,30 +160,37 @@ class ChattyServer(object):
         if to_username:
             # Private message
             message_type = "private"
-            if not to_username in self.message_queues:
+            to_mailbox = self.message_queues.get(to_username)
+            if to_mailbox is None:
                 return False, "No such user."
 
             elif username == to_username:
                 return False, "You can't send private messages to yourself."
             else:
-                self.message_queues[to_username].put_nowait((
-                    "[Private message from %s] %s" % (username, message),
+                to_mailbox.put((
+                    "[Private message from " + username + "] " + message,
                     message_type
                 ))
-                self.message_queues[username].put_nowait((
-                    "[Private message to %s] %s" % (to_username, message),
+                self.message_queues[username].put((
+                    "[Private message to " + to_username + "] " + message,
                     message_type
                 ))
-                logging.info("[Private message from %s to %s sent] %s" % (
+                logging.info(
+                    "[Private message from %s to %s sent] %s",
                     username, to_username, message
-                ))
+                )
                 return True, "Private message sent"
         else:
             # Public message
-            message = "[Public message from %s] %s" % (username, message)
-            for user, queue in self.message_queues.items():
-                queue.put_nowait((message, message_type))
-            logging.info(message)
+            message = "[Public message from " + username + "] " + message
+            self.broadcast_seq += 1
+            self.broadcast_log.append(
+                (self.broadcast_seq, message, message_type)
+            )
+            # Wake up all message listeners currently waiting.
+            self.broadcast_event.set()
+            self.broadcast_event.clear()
+            logging.info("%s", message)
             return True, "Prublic message sent"
 
 
@@ -123,59 +200,81 @@ class ChattyTelnetHandler(object):
     client and the server.
 
     """
+    __slots__ = (
+        "chatty_server", "socket", "address", "username",
+        "_rbuf", "_dispatch",
+    )
+
+    commands = {
+        "help": ("/help", "Print this help message."),
+        "list": ("/list", "List connected users."),
+        "message": ("/message <username> <message>", "Send private message to a user."),
+        "status": ("/status (%s)" % _STATUS_PIPE, "Set your status."),
+        "quit": ("/quit", "Quit ChaTTY.")
+    }
+
     def __init__(self, chatty_server, socket, address):
-        self.config = config
-        self.tick = 0.1
         self.chatty_server = chatty_server
         self.socket = socket
         self.address = address
-        self.fileobj = self.socket.makefile()
+        self._rbuf = bytearray()
         self.username = None
-        self.commands = {
-            "help": ("/help", "Print this help message."),
-            "list": ("/list", "List connected users."),
-            "message": ("/message <username> <message>", "Send private message to a user."),
-            "status": ("/status (%s)" % "|".join(self.config["STATUS_LIST"]), "Set your status."),
-            "quit": ("/quit", "Quit ChaTTY.")
+
+        # Command handlers by long and short command name.
+        self._dispatch = {
+            "help": self.cmd_help,
+            "h": self.cmd_help,
+            "list": self.cmd_list,
+            "l": self.cmd_list,
+            "message": self.cmd_message,
+            "m": self.cmd_message,
+            "status": self.cmd_status,
+            "s": self.cmd_status,
+            "quit": self.cmd_quit,
+            "q": self.cmd_quit,
         }
 
     def read(self):
         """
         Read input from the telnet client.
+        Returns `None` if the client has disconnected.
 
         """
-        return self.fileobj.readline().replace("\r\n", "")
+        while b"\n" not in self._rbuf:
+            try:
+                chunk = self.socket.recv(4096)
+            except gevent.socket.error:
+                # Connection reset or timed out (keepalive gave up).
+                return None
+            if not chunk:
+                return None
+            self._rbuf += chunk
+
+        idx = self._rbuf.index(b"\n")
+        line = bytes(self._rbuf[:idx])
+        del self._rbuf[:idx + 1]
+        return line.rstrip(b"\r").decode("utf-8", "replace")
 
     def write(self, message, prompt=True, message_type=None):
         """
         Write output to the telnet client.
 
         """
-        # Colorize output.
-        if message_type == "status":
-            message = "\x1b[34m%s\x1b[0m" % message
-
-        elif message_type == "private":
-            message = "\x1b[32m%s\x1b[0m" % message
-
-        elif message_type == "public":
-            message = "\x1b[35m%s\x1b[0m" % message
-
-        elif message_type == "info":
-            message = "\x1b[33m%s\x1b[0m" % message
-
-        elif message_type == "warning":
-            message = "\x1b[33m%s\x1b[0m" % message
+        message = self._colorize(message, message_type)
+        if prompt:
+            message += "\n"
 
-        elif message_type == "error":
-            message = "\x1b[31m%s\x1b[0m" % message
+        self.socket.sendall(message.encode("utf-8"))
 
-        if prompt:
-            self.fileobj.write("%s\n" % message)
-        else:
-            self.fileobj.write("%s" % message)
+    def _colorize(self, message, message_type):
+        """
+        Wrap the message in the ANSI color code of its message type.
 
-        self.fileobj.flush()
+        """
+        fmt = _COLOR_CODES.get(message_type)
+        if fmt:
+            return fmt % message
+        return message
 
     def set_username(self):
         """
@@ -185,12 +284,14 @@ class ChattyTelnetHandler(object):
         while not self.username:
             self.write("Username: ", prompt=False)
             username = self.read()
-            username = username.strip().lower().replace(" ", "-")
-
-            if not username:
+            if username is None:
                 logging.info("Client disconnected before setting username")
                 return False
 
+            username = username.strip().lower().replace(" ", "-")
+            if not username:
+                continue
+
             if username in self.chatty_server.connected_users:
                 self.write("Error: A user with that username is already connected. Try again...", message_type="error")
                 continue
@@ -203,41 +304,106 @@ class ChattyTelnetHandler(object):
         Called after the user successfully logs in.
 
         """
+        # Start reading public messages from before our own join message.
+        last_seq = self.chatty_server.broadcast_seq
         self.chatty_server.new_connection(self.username)
 
-        self.write("\nWelcome %s! Get chatty.\n" % self.username, message_type="info")
-
-        self.print_help()
-        self.write("\n")
-
-        self.list_connected_users()
-        self.write("\n")
-
-        # Start the listeners
-        gevent.spawn(self.message_listener)
-        gevent.spawn(self.input_listener)
+        # Grab the mailbox now, the session may already have ended by the
+        # time the message listener first runs.
+        mailbox = self.chatty_server.message_queues[self.username]
+
+        # Welcome message, help message and user list all go out in a
+        # single send.
+        welcome = self._colorize("\nWelcome %s! Get chatty.\n" % self.username, "info")
+        self.socket.sendall(b"".join([
+            (welcome + "\n").encode("utf-8"),
+            self._HELP_BLOB,
+            b"\n\n",
+            self.chatty_server.render_user_list(),
+            b"\n\n",
+        ]))
+
+        # Start the listeners. The input listener runs in the connection's
+        # own greenlet, since the server closes the socket once the
+        # connection handler returns.
+        gevent.spawn(self.message_listener, mailbox, last_seq)
+        try:
+            self.input_listener()
+        except gevent.socket.error:
+            # The client dropped the connection while we were writing to it.
+            self.session_end()
 
     def session_end(self):
         """
-        Called when the user wants to log off.
+        Called when the user wants to log off. Does nothing if the session
+        has already ended.
 
         """
-        self.chatty_server.end_connection(self.username)
-        self.socket.shutdown(gevent.socket.SHUT_RDWR)
+        if self.socket is None:
+            return
+
+        if self.username:
+            self.chatty_server.end_connection(self.username)
+        try:
+            self.socket.shutdown(gevent.socket.SHUT_RDWR)
+        except gevent.socket.error:
+            # The client already dropped the connection.
+            pass
         self.socket.close()
         self.socket = None
 
-    def message_listener(self):
+    def message_listener(self, mailbox, last_seq):
         """
-        Listen for new messages.
+        Listen for new messages. Public messages are read from the server's
+        broadcast log past `last_seq`, private messages from the user's own
+        `mailbox`.
 
         """
-        queue = self.chatty_server.message_queues[self.username]
-        while self.socket:
-            if not queue.empty():
-                message, message_type = queue.get()
-                self.write(message, message_type=message_type)
-            gevent.sleep(self.tick)
+        server = self.chatty_server
+        ended = False
+        while self.socket and not ended:
+            mailbox.ev.clear()
+            batch = []
+
+            # New public messages, oldest first.
+            public = []
+            for entry in reversed(server.broadcast_log):
+                if entry[0] <= last_seq:
+                    break
+                public.append(entry)
+
+            if public:
+                # The log only keeps the latest messages, tell the user if
+                # older ones dropped out of it before we got to them.
+                skipped = public[-1][0] - last_seq - 1
+                if skipped > 0:
+                    batch.append(self._colorize(
+                        "[%d public messages skipped]" % skipped, "warning"
+                    ) + "\n")
+
+                last_seq = public[0][0]
+                for seq, message, message_type in reversed(public):
+                    batch.append(self._colorize(message, message_type) + "\n")
+
+            # Pending private messages. `None` means the session ended.
+            while mailbox.dq:
+                item = mailbox.dq.popleft()
+                if item is None:
+                    ended = True
+                    break
+
+                message, message_type = item
+                batch.append(self._colorize(message, message_type) + "\n")
+
+            if batch:
+                # Send everything that was pending in a single send.
+                if self.socket:
+                    try:
+                        self.socket.sendall("".join(batch).encode("utf-8"))
+                    except gevent.socket.error:
+                        self.session_end()
+            elif not ended:
+                gevent.wait([mailbox.ev, server.broadcast_event], count=1)
 
     def input_listener(self):
         """
@@ -246,36 +412,56 @@ class ChattyTelnetHandler(object):
         """
         while self.socket:
             line = self.read()
-            if line:
-                if line[0] == "/":
-                    # All commands start with a slash.
-                    args = line.split(" ")
+            if line is None:
+                # Client disconnected without /quit.
+                self.session_end()
+                break
+
+            if line.startswith("/"):
+                # All commands start with a slash. Grab the command without
+                # the leading slash, unknown commands print the help message.
+                command, _, args = line[1:].partition(" ")
+                self._dispatch.get(command, self.cmd_help)(args)
+
+            elif line:
+                self.send_message(line)
+
+    # Command handlers, called with the arguments following the command.
+    def cmd_help(self, args):
+        """
+        /help
 
-                    # Grab the command without the leading slash
-                    command = args[0][1:]
+        """
+        self.print_help()
 
-                    if command == "list" or command == "l":
-                        self.list_connected_users()
+    def cmd_list(self, args):
+        """
+        /list
 
-                    elif command == "message" or command == "m":
-                        to_username = args[1]
-                        message = " ".join(args[2:])
-                        self.send_message(message, to_username=to_username)
+        """
+        self.list_connected_users()
 
-                    elif command == "status" or command == "s":
-                        status = args[1]
-                        self.set_status(status)
+    def cmd_message(self, args):
+        """
+        /message <username> <message>
 
-                    elif command == "quit" or command == "q":
-                        self.session_end()
+        """
+        to_username, _, message = args.partition(" ")
+        self.send_message(message, to_username=to_username)
+
+    def cmd_status(self, args):
+        """
+        /status <status>
 
-                    else:
-                        self.print_help()
+        """
+        self.set_status(args.partition(" ")[0])
 
-                else:
-                    self.send_message(line)
+    def cmd_quit(self, args):
+        """
+        /quit
 
-            gevent.sleep(self.tick)
+        """
+        self.session_end()
 
     # Command methods
     def print_help(self):
@@ -283,24 +469,27 @@ class ChattyTelnetHandler(object):
         Display help message to telnet client.
 
         """
-        self.write("  Usage:", message_type="info")
-        for command, command_help in self.commands.items():
-            self.write("   %s: %s" % (
-                command_help[0], command_help[1]),  message_type="info"
-            )
-        self.write("   <message>: %s" % "Send a public message to all connected users", message_type="info")
+        self.socket.sendall(self._HELP_BLOB)
 
-    def list_connected_users(self):
+    @classmethod
+    def _render_help(cls):
         """
-        Display connected users to telnet client.
+        Render the colorized help message.
 
         """
+        fmt = _COLOR_CODES["info"] + "\n"
+        lines = [fmt % "  Usage:"]
+        for command, command_help in cls.commands.items():
+            lines.append(fmt % ("   %s: %s" % (command_help[0], command_help[1])))
+        lines.append(fmt % ("   <message>: %s" % "Send a public message to all connected users"))
+        return "".join(lines).encode("utf-8")
 
-        connected_users = self.chatty_server.connected_users
+    def list_connected_users(self):
+        """
+        Display connected users to telnet client.
 
-        self.write("  CONNECTED USERS:", message_type="status")
-        for user, status in connected_users.items():
-            self.write("    %s (%s)" % (user, status), message_type="status")
+        """
+        self.socket.sendall(self.chatty_server.render_user_list())
 
     def set_status(self, status):
         """
@@ -327,8 +516,17 @@ class ChattyTelnetHandler(object):
                 self.write("ERROR: %s" % msg, message_type="error")
 
 
+# Rendered help message, shared by all handlers.
+ChattyTelnetHandler._HELP_BLOB = ChattyTelnetHandler._render_help()
+
+
 def connection_handler(socket, address):
 
+    # Chat lines are short, send them right away instead of letting Nagle's
+    # algorithm hold them back. Keepalive evicts dead clients.
+    socket.setsockopt(gevent.socket.IPPROTO_TCP, gevent.socket.TCP_NODELAY, 1)
+    socket.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_KEEPALIVE, 1)
+
     handler = ChattyTelnetHandler(chatty_server, socket, address)
 
     # O HAI.
@@ -351,9 +549,9 @@ if __name__ == '__main__':
         connection_handler
     )
 
-    logging.info("Started ChaTTY server on port %s.  (Ctrl-C to stop)" % (
-        config["PORT"]
-    ))
+    logging.info(
+        "Started ChaTTY server on port %s.  (Ctrl-C to stop)", config["PORT"]
+    )
 
     try:
         gevent_server.serve_forever()
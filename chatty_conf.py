@@ -1,5 +1,6 @@
 config = {
     "HOST": "",
     "PORT": 1337,
-    "STATUS_LIST": ["Online", "Away", "DND"]
+    "STATUS_LIST": ["Online", "Away", "DND"],
+    "LOG_LEVEL": "DEBUG"
 }